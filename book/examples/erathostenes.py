@@ -3,11 +3,18 @@
 
 __author__ = "Fernando Perez <Fernando.Perez@colorado.edu>"
 
+import os
 import sys
 import math
+import tempfile
 
 import numpy as np
 
+# The segmented sieve kernels live with the other NumPy prime code in
+# hpc/prime3.py, which has to stay importable on its own from hpc/.
+from hpc.prime3 import SEGMENT_SIZE, base_primes, sieve_segment
+from hpc.prime3 import isqrt as _isqrt
+
 def sieve_quad(nmax):
     """Return a list of prime numbers up to nmax.
 
@@ -99,6 +106,184 @@ def sieve(nmax):
 
     return primes_head + primes_tail_lst
 
+#-----------------------------------------------------------------------------
+# Segmented sieve
+#-----------------------------------------------------------------------------
+
+def iter_sieve_segments(nmax, segment_size=SEGMENT_SIZE):
+    """Generate the prime numbers up to nmax, one NumPy array per segment.
+
+    Each segment covers 2*segment_size consecutive integers.  Only the primes
+    up to sqrt(nmax) and a single segment are held in memory at any time."""
+
+    # Sanity checks
+    assert nmax>1, "nmax must be > 1"
+    assert segment_size>0, "segment_size must be > 0"
+
+    primes = base_primes(_isqrt(nmax))
+    span = 2*segment_size
+    for lo in xrange(0, nmax+1, span):
+        yield sieve_segment(lo, min(lo+span, nmax+1), primes)
+
+
+def sieve_segmented(nmax, segment_size=SEGMENT_SIZE):
+    """Return a list of prime numbers up to nmax, using a segmented sieve.
+
+    Same result as sieve, but the work is done on fixed-size NumPy segments of
+    odd numbers, so memory use is O(sqrt(nmax)) plus one segment instead of
+    O(nmax).  See iter_sieve_segments to stream the primes instead."""
+
+    primes = []
+    for seg_primes in iter_sieve_segments(nmax, segment_size):
+        primes.extend(seg_primes.tolist())
+    return primes
+
+
+class PrimeIterator(object):
+    """Iterator over the prime numbers p with start <= p < stop.
+
+    Each step sieves one segment of 2*segment_size integers and returns its
+    primes as a NumPy array, so chunks have a bounded size.
+
+    The iteration can be checkpointed between chunks with state(), and later
+    continued (possibly in another process) with resume_primes(state): the
+    checkpoint carries the next segment boundary and the base primes, so no
+    earlier range is ever sieved again."""
+
+    def __init__(self, start, stop, segment_size=SEGMENT_SIZE, primes=None):
+        assert segment_size>0, "segment_size must be > 0"
+        # Next integer to be sieved
+        self.position = max(start, 2)
+        self.stop = stop
+        self.segment_size = segment_size
+        if primes is None:
+            primes = base_primes(_isqrt(max(stop-1, 0)))
+        self.primes = primes
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        if self.position >= self.stop:
+            raise StopIteration
+        hi = min(self.position + 2*self.segment_size, self.stop)
+        chunk = sieve_segment(self.position, hi, self.primes)
+        self.position = hi
+        return chunk
+
+    def state(self):
+        """Return a checkpoint of the iteration, as a dict.
+
+        The dict only holds integers and a NumPy array, so it can be pickled
+        or saved with np.savez."""
+        return dict(position=self.position, stop=self.stop,
+                    segment_size=self.segment_size, primes=self.primes)
+
+
+def iter_primes(start, stop, segment_size=SEGMENT_SIZE):
+    """Return an iterator over the primes p with start <= p < stop.
+
+    The primes are generated in NumPy chunks of one sieve segment each.  See
+    PrimeIterator for how to checkpoint and resume the iteration."""
+    return PrimeIterator(start, stop, segment_size)
+
+
+def resume_primes(state):
+    """Return an iterator continuing from a PrimeIterator.state() checkpoint."""
+    return PrimeIterator(state['position'], state['stop'],
+                         state['segment_size'], state['primes'])
+
+
+#-----------------------------------------------------------------------------
+# Persistent prime table
+#-----------------------------------------------------------------------------
+
+class PrimeCache(object):
+    """A table of primes cached on disk, in a memory-mapped .npy file.
+
+    The file holds a single int64 array: its first entry is the bound nmax up
+    to which the table is complete, and the rest are the primes up to nmax.
+    Keeping the bound inside the same file means the two can never disagree.
+
+    Requests for smaller bounds are served by slicing the memory-mapped table
+    (nothing is read from disk until used).  A larger bound extends the table
+    with the segmented sieve, starting where the cached one stopped, and
+    rewrites it to a temporary file that is then renamed over the old one.
+    The rename is atomic on POSIX systems, so concurrent readers always see
+    either the old or the new complete table, and readers which already
+    mapped the old file keep a valid view of it."""
+
+    def __init__(self, filename, segment_size=SEGMENT_SIZE):
+        self.filename = filename
+        self.segment_size = segment_size
+        self._table = None
+
+    def bound(self):
+        """Return the bound up to which the cached table is complete."""
+        if self._table is None:
+            self._load()
+        return int(self._table[0])
+
+    def primes(self, nmax):
+        """Return a NumPy array (a read-only memory map) of the primes up to
+        nmax, extending the cached table first if needed."""
+        if self.bound() < nmax:
+            # Another process may have extended the file meanwhile
+            self._load()
+            if self.bound() < nmax:
+                self._extend(nmax)
+        primes = self._table[1:]
+        return primes[:np.searchsorted(primes, nmax, 'right')]
+
+    def sieve(self, nmax):
+        """Return a list of prime numbers up to nmax, like sieve(nmax)."""
+        assert nmax>1, "nmax must be > 1"
+        return self.primes(nmax).tolist()
+
+    def _load(self):
+        if os.path.exists(self.filename):
+            self._table = np.load(self.filename, mmap_mode='r')
+        else:
+            self._table = np.zeros(1, dtype=np.int64)
+
+    def _extend(self, nmax):
+        # Grow at least geometrically, so that a sequence of slowly growing
+        # requests only rewrites the file a logarithmic number of times.
+        old_bound = self.bound()
+        new_bound = max(nmax, 2*old_bound)
+        new_primes = list(iter_primes(old_bound+1, new_bound+1,
+                                      self.segment_size))
+        old_size = len(self._table)
+        size = old_size + sum(len(p) for p in new_primes)
+
+        dirname = os.path.dirname(os.path.abspath(self.filename))
+        fd, tmpname = tempfile.mkstemp(suffix='.npy', dir=dirname)
+        os.close(fd)
+        try:
+            table = np.lib.format.open_memmap(tmpname, mode='w+',
+                                              dtype=np.int64, shape=(size,))
+            table[:old_size] = self._table
+            table[0] = new_bound
+            start = old_size
+            for chunk in new_primes:
+                table[start:start+len(chunk)] = chunk
+                start += len(chunk)
+            table.flush()
+            del table
+            os.rename(tmpname, self.filename)
+        except:
+            os.remove(tmpname)
+            raise
+        self._load()
+
+
+def sieve_cached(nmax, filename):
+    """Return a list of prime numbers up to nmax, cached in filename.
+
+    See PrimeCache for details."""
+    return PrimeCache(filename).sieve(nmax)
+
+
 if __name__ == '__main__':
     # A simple test suite.
     import unittest
@@ -128,6 +313,66 @@ if __name__ == '__main__':
     class sieve_quad2TestCase(sieveTestBase,unittest.TestCase):
         sieve_func = staticmethod(sieve_quad2)
 
+    class sieve_segmentedTestCase(sieveTestBase,unittest.TestCase):
+        sieve_func = staticmethod(sieve_segmented)
+
+        def test_segment_sizes(self):
+            # Tiny segments exercise the handling of segment boundaries.
+            primes = sieve(2000)
+            for segment_size in [1, 2, 3, 7, 64, 1000]:
+                self.assert_(sieve_segmented(2000, segment_size)==primes)
+
+        def test_stream(self):
+            segments = list(iter_sieve_segments(1001, 50))
+            self.assertEqual(len(segments), 11)
+            self.assert_(np.concatenate(segments).tolist()==sieve(1001))
+
+    class iter_primesTestCase(unittest.TestCase):
+
+        def test_range(self):
+            chunks = list(iter_primes(100, 1000, 16))
+            self.assert_(max(len(c) for c in chunks) <= 16)
+            expected = [p for p in sieve(1000) if p >= 100]
+            self.assert_(np.concatenate(chunks).tolist()==expected)
+
+        def test_empty(self):
+            self.assertEqual(list(iter_primes(0, 2)), [])
+            self.assertEqual(np.concatenate(list(iter_primes(24, 29))).size, 0)
+
+        def test_resume(self):
+            it = iter_primes(0, 5000, 100)
+            head = [it.next() for i in range(3)]
+            state = it.state()
+            self.assertEqual(state['position'], 602)
+            tail = list(resume_primes(state))
+            self.assert_(np.concatenate(head+tail).tolist()==sieve(4999))
+
+    class PrimeCacheTestCase(sieveTestBase,unittest.TestCase):
+
+        def setUp(self):
+            self.tmpdir = tempfile.mkdtemp()
+            self.filename = os.path.join(self.tmpdir, 'primes.npy')
+            self.sieve_func = PrimeCache(self.filename).sieve
+
+        def tearDown(self):
+            import shutil
+            shutil.rmtree(self.tmpdir)
+
+        def test_extend(self):
+            cache = PrimeCache(self.filename, segment_size=10)
+            self.assert_(cache.sieve(100)==sieve(100))
+            self.assertEqual(cache.bound(), 100)
+            self.assert_(cache.sieve(1000)==sieve(1000))
+            self.assert_(cache.sieve(50)==sieve(50))
+            self.assertEqual(cache.bound(), 1000)
+
+        def test_shared(self):
+            # A second cache on the same file picks up the first one's work
+            reader = PrimeCache(self.filename)
+            self.assert_(sieve_cached(1000, self.filename)==sieve(1000))
+            self.assertEqual(reader.bound(), 1000)
+            self.assert_(reader.sieve(999)==sieve(999))
+
     # Other code for demonstration purposes
     def time_rng(fun,nrange,ret_both=0,verbose=1):
         """Time a function over a range of parameters.
@@ -184,6 +429,7 @@ if __name__ == '__main__':
         plot_sieve(sieve,'Set-based')
         plot_sieve(sieve_quad,'Quad')
         plot_sieve(sieve_quad,'Quad2')
+        plot_sieve(sieve_segmented,'Segmented')
 
         plt.legend()
         plt.show()
@@ -1,91 +1,503 @@
 """pool.py: A simple poll implementation using threads or processes."""
 
+import cPickle as pickle
+import itertools
 import multiprocessing
+import os
 import Queue
 from Queue import Empty
+import sys
+import tempfile
 import threading
+import traceback
 
-class SimpleThreadPool(object):
-    """A simple thread pool."""
+import numpy as np
 
-    def __init__(self, size=2):
-        self.size = size
+def _default_chunksize(n, size):
+    """Return a chunksize splitting n items into about 4 chunks per worker."""
+    chunksize, extra = divmod(n, 4*size)
+    if extra:
+        chunksize += 1
+    return max(chunksize, 1)
 
-    def _do_work(self, f, in_queue, out_queue):
-        while True:
-            try:
-                arg = in_queue.get(block=False)
-                result = f(arg)
-                out_queue.put(result)
-                # This allows us to call in_queue.join().
-                in_queue.task_done()
-            except Empty:
-                break
+def _iter_chunks(iterable, chunksize):
+    """Lazily split iterable into lists of chunksize items."""
+    it = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(it, chunksize))
+        if not chunk:
+            return
+        yield chunk
 
-    def map(self, f, seq):
-        """A parallel version of Python's map function."""
+def _cost_chunks(seq, cost, nchunks):
+    """Split seq into about nchunks chunks of similar total cost.
 
-        assert callable(f), "first argument must be a single argument callable"
-        in_queue = Queue.Queue()
-        out_queue = Queue.Queue()
-        for arg in seq:
-            in_queue.put(arg)
-        workers = [
-            threading.Thread(
-                target=self._do_work, 
-                args=(f, in_queue, out_queue)
-            ) for i in range(self.size)]
-        for w in workers:
-            w.start()
-        in_queue.join()
-        results = [out_queue.get(block=False) for n in range(out_queue.qsize())]
-        for w in workers:
-            w.join()
-        return results
+    The items are sorted by decreasing cost(item) first, so the chunks with
+    the most expensive items come first.  Returns (order, chunks), where
+    order lists the indices into seq of the items in that sorted order."""
+    costs = [cost(x) for x in seq]
+    order = sorted(xrange(len(seq)), key=costs.__getitem__, reverse=True)
+    target = sum(costs)/float(nchunks)
+    chunks = []
+    chunk, chunk_cost = [], 0
+    for i in order:
+        chunk.append(seq[i])
+        chunk_cost += costs[i]
+        if chunk_cost >= target:
+            chunks.append(chunk)
+            chunk, chunk_cost = [], 0
+    if chunk:
+        chunks.append(chunk)
+    return order, chunks
+
+# Shared arrays live in RAM backed files when the system has a place for them.
+if os.path.isdir('/dev/shm'):
+    _SHARED_DIR = '/dev/shm'
+else:
+    _SHARED_DIR = None
+
+class SharedArray(object):
+    """A NumPy array in a memory-mapped file, to share it between processes.
+
+    The data is in the array attribute.  When a SharedArray is pickled, for
+    example to send it to a worker process, only the file name, dtype and
+    shape are written; unpickling maps the same file again, so the data is
+    never copied and writes in any process are seen by all of them.
+
+    The process that created the array owns the file, and deletes it on
+    close() (or when the array is garbage collected)."""
+
+    def __init__(self, shape, dtype=float):
+        fd, self.filename = tempfile.mkstemp(suffix='.npy', dir=_SHARED_DIR)
+        os.close(fd)
+        self._owner = True
+        self.array = np.lib.format.open_memmap(self.filename, mode='w+',
+                                               dtype=dtype, shape=shape)
+
+    @classmethod
+    def from_array(cls, a):
+        """Return a SharedArray holding a copy of the array a."""
+        a = np.asarray(a)
+        shared = cls(a.shape, a.dtype)
+        shared.array[...] = a
+        return shared
+
+    def __getstate__(self):
+        return self.filename
+
+    def __setstate__(self, filename):
+        self.filename = filename
+        self._owner = False
+        self.array = np.load(filename, mmap_mode='r+')
+
+    def close(self):
+        """Delete the backing file, if this is the process that owns it."""
+        if self._owner:
+            self._owner = False
+            os.remove(self.filename)
 
-class SimpleProcessPool(object):
-    """A simple process pool."""
+    def __del__(self):
+        self.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+def _as_ndarray(a):
+    if isinstance(a, SharedArray):
+        return a.array
+    return a
+
+class _ArrayTask(object):
+    """Sets out[i] = f(a[i]) for the rows i in a (start, stop) range."""
+
+    def __init__(self, f, a, out):
+        self.f = f
+        self.a = a
+        self.out = out
+
+    def __call__(self, bounds):
+        a, out = _as_ndarray(self.a), _as_ndarray(self.out)
+        for i in xrange(*bounds):
+            out[i] = self.f(a[i])
+
+class _Failure(object):
+    """An exception raised in a worker, to be re-raised by the caller."""
+
+    def __init__(self, exc_info):
+        self.exc_type, self.exc_value, self.tb = exc_info
+        self.traceback = ''.join(traceback.format_exception(*exc_info))
+
+    def __getstate__(self):
+        # Traceback objects can't be pickled, and neither can all exceptions,
+        # so only the formatted traceback is sure to reach another process.
+        state = self.__dict__.copy()
+        state['tb'] = None
+        try:
+            pickle.loads(pickle.dumps(self.exc_value, -1))
+        except Exception:
+            state['exc_type'] = Exception
+            state['exc_value'] = Exception(
+                traceback.format_exception_only(self.exc_type,
+                                                self.exc_value)[-1].strip())
+        return state
+
+    def reraise(self):
+        """Raise the original exception, with its original traceback if it
+        is available (threads), or else with the worker's traceback as text
+        in its remote_traceback attribute (processes)."""
+        if self.tb is None:
+            self.exc_value.remote_traceback = self.traceback
+        raise self.exc_type, self.exc_value, self.tb
+
+def _do_work(in_queue, out_queue, pickled=False):
+    """The loop run by each worker thread or process.
+
+    If pickled is true, the tasks arrive pickled, and the results are
+    pickled here too, so that a result which can't be pickled is reported
+    like any other exception."""
+    while True:
+        task = in_queue.get()
+        # None is the signal that there is no more work.
+        if task is None:
+            break
+        if pickled:
+            task = pickle.loads(task)
+        job, index, f, chunk = task
+        try:
+            results = [f(arg) for arg in chunk]
+            if pickled:
+                results = pickle.dumps(results, -1)
+        except:
+            # Hand the exception over to the caller.  If it killed the worker
+            # instead, the caller would wait forever for this chunk.
+            results = _Failure(sys.exc_info())
+        out_queue.put((job, index, results))
+
+class _WorkerPool(object):
+    """The logic shared by SimpleThreadPool and SimpleProcessPool.
+
+    The workers are started the first time the pool is used and then wait
+    for more work until close() is called, so their startup cost is only
+    paid once.  Subclasses say what a worker and a queue are.
+
+    If the mapped function raises, the exception is re-raised in the caller
+    (see _Failure) and the pool remains usable."""
+
+    # How long to wait for a result before checking that all the workers are
+    # still alive.  None means forever, which is fine for threads: they catch
+    # every exception, so they can't die while the pool is running.
+    _poll_interval = None
+
+    # Whether tasks and results are pickled before being queued, which is
+    # needed to catch pickling errors when the queues lead to other processes.
+    _pickled = False
 
     def __init__(self, size=2):
         self.size = size
+        self._workers = None
+        self._jobs = itertools.count()
+        # Results that arrived for other jobs than the one being waited on:
+        # {job: [(index, results), ...]}
+        self._stash = {}
+        # Number of results still to come for jobs nobody is waiting for
+        self._abandoned = {}
 
-    def _do_work(self, f, in_queue, out_queue):
-        while True:
-            try:
-                arg = in_queue.get(block=False)
-                result = f(arg)
-                out_queue.put(result)
-                # This allows us to call in_queue.join() below.
-                in_queue.task_done()
-            except Empty:
-                break
+    def _new_queue(self):
+        raise NotImplementedError
 
-    def map(self, f, seq):
-        """A parallel version of Python's map function."""
+    def _new_worker(self, target, args):
+        raise NotImplementedError
 
+    def _check_function(self, f):
         assert callable(f), "first argument must be a single argument callable"
-        in_queue = multiprocessing.JoinableQueue()
-        out_queue = multiprocessing.JoinableQueue()
-        for arg in seq:
-            in_queue.put(arg)
-        workers = [
-            multiprocessing.Process(
-                target=self._do_work, 
-                args=(f, in_queue, out_queue)
+
+    def _terminate(self):
+        """Shut down the workers without waiting for the work in progress."""
+        for w in self._workers:
+            self._in_queue.put(None)
+
+    def _put_task(self, task):
+        if self._pickled:
+            # An argument that can't be pickled raises here, instead of in
+            # the background thread that feeds a multiprocessing queue, where
+            # the chunk would be lost and we would wait for it forever.
+            task = pickle.dumps(task, -1)
+        self._in_queue.put(task)
+
+    def _start(self):
+        if self._workers is not None:
+            return
+        self._in_queue = self._new_queue()
+        self._out_queue = self._new_queue()
+        self._workers = [
+            self._new_worker(
+                target=_do_work,
+                args=(self._in_queue, self._out_queue, self._pickled)
             ) for i in range(self.size)]
-        for w in workers:
+        for w in self._workers:
+            # Don't keep the interpreter alive if close() is never called.
+            w.daemon = True
             w.start()
-        in_queue.join()
-        results = []
+
+    def close(self):
+        """Stop the workers, after they finish the work already submitted.
+
+        The pool can still be used afterwards: it then starts new workers."""
+        if self._workers is None:
+            return
+        for w in self._workers:
+            self._in_queue.put(None)
+        # Results of abandoned jobs must be drained, or a worker process
+        # could block forever flushing them to out_queue and never exit.
+        for w in self._workers:
+            while w.is_alive():
+                try:
+                    self._out_queue.get(timeout=0.1)
+                except Empty:
+                    pass
+            w.join()
+        self._reset()
+
+    def _reset(self):
+        self._workers = None
+        self._stash.clear()
+        self._abandoned.clear()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _get_result(self, job):
+        """Return the next (index, results) pair that arrives for job."""
+        if self._stash.get(job):
+            return self._stash[job].pop(0)
         while True:
             try:
-                result = out_queue.get(block=False)
+                other, index, results = self._out_queue.get(
+                    timeout=self._poll_interval)
             except Empty:
-                break
+                self._check_workers()
+                continue
+            if other == job:
+                return index, results
+            if other in self._abandoned:
+                self._abandoned[other] -= 1
+                if not self._abandoned[other]:
+                    del self._abandoned[other]
             else:
-                results.append(result)
-        for w in workers:
-            w.join()
+                self._stash.setdefault(other, []).append((index, results))
+
+    def _check_workers(self):
+        """Raise RuntimeError, after shutting down the pool, if a worker has
+        died: the chunk it was working on would never come back."""
+        if all(w.is_alive() for w in self._workers):
+            return
+        self._terminate()
+        self._reset()
+        raise RuntimeError("a pool worker died unexpectedly")
+
+    def _imap(self, f, chunks, ordered, max_in_flight):
+        """Generate the results of f over the items of an iterable of chunks
+        (lists of items)."""
+        self._check_function(f)
+        self._start()
+        job = self._jobs.next()
+        chunks = enumerate(chunks)
+        exhausted = False
+        in_flight = 0
+        # Ordered results waiting for an earlier chunk to arrive
+        waiting = {}
+        next_index = 0
+        try:
+            while True:
+                # Keep at most max_in_flight chunks submitted but not yet
+                # returned, reading the input only as fast as it is used.
+                while not exhausted and (max_in_flight is None or
+                                         in_flight < max_in_flight):
+                    try:
+                        index, chunk = chunks.next()
+                    except StopIteration:
+                        exhausted = True
+                    else:
+                        self._put_task((job, index, f, chunk))
+                        in_flight += 1
+                if not in_flight:
+                    break
+                index, results = self._get_result(job)
+                in_flight -= 1
+                if self._pickled and not isinstance(results, _Failure):
+                    results = pickle.loads(results)
+                if not ordered:
+                    if isinstance(results, _Failure):
+                        results.reraise()
+                    for result in results:
+                        yield result
+                    continue
+                waiting[index] = results
+                while next_index in waiting:
+                    results = waiting.pop(next_index)
+                    if isinstance(results, _Failure):
+                        results.reraise()
+                    for result in results:
+                        yield result
+                    next_index += 1
+        finally:
+            # If the caller stopped early, forget about the results to come.
+            # Those already stashed are no longer in the queue.
+            pending = in_flight - len(self._stash.pop(job, []))
+            if pending:
+                self._abandoned[job] = pending
+
+    def map(self, f, seq, chunksize=None, cost=None):
+        """A parallel version of Python's map function.
+
+        The input is sent to the workers in chunks of chunksize items (by
+        default about 4 chunks per worker).  Each chunk is tagged with its
+        index, so the results are returned in the same order as seq.
 
+        For workloads where some items take much longer than others, cost
+        can be a function estimating the relative time f(item) takes (for
+        example ``lambda n: n**1.5``).  The chunks are then made of about
+        equal total cost instead of equal length, and the most expensive
+        ones are sent first: since idle workers always take the next chunk
+        from the shared queue, the cheap chunks at the end fill in the gaps
+        and all the workers finish at about the same time."""
+        seq = list(seq)
+        if cost is None:
+            if chunksize is None:
+                chunksize = _default_chunksize(len(seq), self.size)
+            return list(self._imap(f, _iter_chunks(seq, chunksize), True, None))
+
+        if chunksize is None:
+            nchunks = 4*self.size
+        else:
+            nchunks = max(-(-len(seq)//chunksize), 1)
+        order, chunks = _cost_chunks(seq, cost, nchunks)
+        results = [None]*len(seq)
+        for i, result in itertools.izip(order, self._imap(f, chunks, True,
+                                                          None)):
+            results[i] = result
         return results
 
+    def map_array(self, f, a, out, chunksize=None):
+        """Set out[i] = f(a[i]) for every row of the array a, in parallel.
+
+        a and out can be NumPy arrays or SharedArrays.  With a process pool
+        SharedArrays are best: the workers then read their rows of a and
+        write their rows of out in place, and only index ranges and file
+        names are sent through the queues.  Returns out."""
+        n = len(_as_ndarray(a))
+        if chunksize is None:
+            chunksize = _default_chunksize(n, self.size)
+        ranges = [(start, min(start+chunksize, n))
+                  for start in xrange(0, n, chunksize)]
+        for result in self._imap(_ArrayTask(f, a, out), _iter_chunks(ranges, 1),
+                                 True, None):
+            pass
+        return out
+
+    def imap(self, f, iterable, chunksize=1, max_in_flight=None):
+        """A lazy, parallel version of itertools.imap.
+
+        The input is consumed only as needed to keep max_in_flight chunks
+        (by default 2 per worker) submitted to the workers, and the results
+        are yielded in input order as soon as they are available."""
+        if max_in_flight is None:
+            max_in_flight = 2*self.size
+        return self._imap(f, _iter_chunks(iterable, chunksize), True,
+                          max_in_flight)
+
+    def imap_unordered(self, f, iterable, chunksize=1, max_in_flight=None):
+        """Like imap, but yield the results in the order they complete."""
+        if max_in_flight is None:
+            max_in_flight = 2*self.size
+        return self._imap(f, _iter_chunks(iterable, chunksize), False,
+                          max_in_flight)
+
+class SimpleThreadPool(_WorkerPool):
+    """A simple thread pool."""
+
+    def _new_queue(self):
+        return Queue.Queue()
+
+    def _new_worker(self, target, args):
+        return threading.Thread(target=target, args=args)
+
+    def parallel_for(self, kernel, n, nslices=None):
+        """Call kernel(start, stop) over contiguous slices of range(n).
+
+        The range is split into nslices slices (by default one per thread)
+        and the calls run concurrently in the pool's threads.  Returns the
+        list of their results, in slice order.
+
+        This only gives a speedup if kernel spends its time with the GIL
+        released, like the Cython functions in prime2 and vector_add do in
+        their ``with nogil`` blocks."""
+        if nslices is None:
+            nslices = self.size
+        edges = [n*i//nslices for i in range(nslices+1)]
+        bounds = [(start, stop) for start, stop in zip(edges[:-1], edges[1:])
+                  if stop > start]
+        return self.map(lambda b: kernel(*b), bounds, 1)
+
+    def map_slices(self, kernel, *arrays):
+        """Call kernel(*[a[start:stop] for a in arrays]) over slices of the
+        arrays' first axis, using parallel_for.
+
+        The slices are views, so nothing is copied: for example, with the
+        nogil vector_add(a, b, c) kernel, map_slices(vector_add, a, b, c)
+        fills c in place, each thread writing its own part of it."""
+        n = len(arrays[0])
+        def kernel_slice(start, stop):
+            return kernel(*[a[start:stop] for a in arrays])
+        return self.parallel_for(kernel_slice, n)
+
+class SimpleProcessPool(_WorkerPool):
+    """A simple process pool.
+
+    The functions and arguments are sent to the worker processes through
+    multiprocessing queues, so they must be picklable."""
+
+    # A worker process can die without an exception (a crash in C code, or
+    # being killed), so check on them regularly.
+    _poll_interval = 0.1
+
+    _pickled = True
+
+    def _new_queue(self):
+        return multiprocessing.Queue()
+
+    def _new_worker(self, target, args):
+        return multiprocessing.Process(target=target, args=args)
+
+    def map_array(self, f, a, out, chunksize=None):
+        """Set out[i] = f(a[i]) for every row of the array a, in parallel.
+
+        The worker processes can only see a and out through shared memory,
+        so plain NumPy arrays are copied into temporary SharedArrays first,
+        and the results copied back into out.  Returns out."""
+        temporary = []
+        def shared(x):
+            if isinstance(x, SharedArray):
+                return x
+            temporary.append(SharedArray.from_array(x))
+            return temporary[-1]
+        try:
+            shared_out = shared(out)
+            _WorkerPool.map_array(self, f, shared(a), shared_out, chunksize)
+            if shared_out is not out:
+                out[...] = shared_out.array
+        finally:
+            for x in temporary:
+                x.close()
+        return out
+
+    def _terminate(self):
+        for w in self._workers:
+            w.terminate()
+            w.join()
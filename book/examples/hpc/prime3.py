@@ -0,0 +1,245 @@
+"""prime3.py: NumPy versions of the prime functions, using a segmented sieve."""
+
+import math
+
+import numpy as np
+
+# Number of odd candidates held in one sieve segment.  Each candidate takes a
+# single byte, so a segment is 256kb and fits comfortably in L2 cache.
+SEGMENT_SIZE = 2**18
+
+def isqrt(n):
+    """Returns the integer square root of n, i.e. floor(sqrt(n))."""
+    r = int(math.sqrt(n))
+    while r*r > n:
+        r -= 1
+    while (r+1)*(r+1) <= n:
+        r += 1
+    return r
+
+def base_primes(n):
+    """Returns a NumPy array with the primes up to n (plain odd-only sieve)."""
+    if n < 2:
+        return np.empty(0, dtype=np.int64)
+    # is_prime[i] stands for the odd number 2*i+1
+    is_prime = np.ones((n+1)//2, dtype=np.bool_)
+    is_prime[0] = False
+    for i in xrange(1, (isqrt(n)+1)//2):
+        if is_prime[i]:
+            p = 2*i+1
+            is_prime[p*p//2::p] = False
+    odd_primes = 2*np.flatnonzero(is_prime)+1
+    return np.concatenate(([2], odd_primes)).astype(np.int64)
+
+def sieve_segment(lo, hi, primes):
+    """Returns a NumPy array with the primes p such that lo <= p < hi.
+
+    primes must contain, in increasing order, at least all the primes up to
+    sqrt(hi-1).  Only the odd numbers in [lo,hi) are sieved, one byte each."""
+    lo = max(lo, 2)
+    if hi <= lo:
+        return np.empty(0, dtype=np.int64)
+    # is_prime[i] stands for the odd number first+2*i
+    first = lo | 1
+    is_prime = np.ones((hi-first+1)//2, dtype=np.bool_)
+    for p in primes[1:]:
+        p = int(p)
+        if p*p >= hi:
+            break
+        # First odd multiple of p in the segment, never p itself
+        start = max(p*p, ((first+p-1)//p)*p)
+        if start % 2 == 0:
+            start += p
+        is_prime[(start-first)//2::p] = False
+    if first == 1:
+        is_prime[0] = False
+    seg_primes = first + 2*np.flatnonzero(is_prime)
+    if lo == 2:
+        seg_primes = np.concatenate(([2], seg_primes))
+    return seg_primes.astype(np.int64)
+
+def sieve_range(lo, hi, primes=None, segment_size=SEGMENT_SIZE):
+    """Returns a NumPy array with the primes p such that lo <= p < hi.
+
+    The range is sieved in cache-sized segments of 2*segment_size integers.
+    If primes (the base primes up to sqrt(hi-1)) is not given, it is
+    computed."""
+    if primes is None:
+        primes = base_primes(isqrt(max(hi-1, 0)))
+    span = 2*segment_size
+    chunks = [sieve_segment(start, min(start+span, hi), primes)
+              for start in xrange(max(lo, 2), hi, span)]
+    if not chunks:
+        return np.empty(0, dtype=np.int64)
+    return np.concatenate(chunks)
+
+def sieve(n):
+    """Returns a NumPy array with the primes up to n."""
+    return sieve_range(2, n+1)
+
+#-----------------------------------------------------------------------------
+# Batch primality testing
+#-----------------------------------------------------------------------------
+
+# Candidates are first trial divided by these primes.  Any survivor below the
+# square of the largest one is prime.
+_SMALL_PRIMES = base_primes(256)
+
+# Deterministic Miller-Rabin witnesses: the first set is exact for all
+# n < 2**32, the second one for all n < 2**64.
+_MR_BASES_32 = (2, 7, 61)
+_MR_BASES_64 = (2, 325, 9375, 28178, 450775, 9780504, 1795265022)
+
+# NumPy has no 128 bit integers, so above 2**32 a*b % n is computed with the
+# long double trick (see _mulmod_ld), which is exact for n < 2**62 when long
+# double has a 64 bit mantissa, as on x86.  Anything larger is tested one
+# number at a time with Python integers.
+if np.finfo(np.longdouble).nmant >= 63:
+    _MULMOD_LD_MAX = 2**62
+else:
+    _MULMOD_LD_MAX = 2**32
+
+def _mulmod_32(n):
+    """Returns a function computing a*b % n, for a, b < n <= 2**32."""
+    def mulmod(a, b):
+        return a*b % n
+    return mulmod
+
+def _mulmod_ld(n):
+    """Returns a function computing a*b % n, for a, b < n <= 2**62.
+
+    The quotient q = a*b/n is estimated in long double, using a precomputed
+    1/n, and is off by at most one.  The remainder a*b - q*n is then computed
+    exactly in wrapping 64 bit integer arithmetic and corrected into [0,n)."""
+    ninv = 1/n.astype(np.longdouble)
+    ni = n.view(np.int64)
+    def mulmod(a, b):
+        q = (a.astype(np.longdouble)*b*ninv).astype(np.uint64)
+        r = (a*b - q*n).view(np.int64)
+        r += ni*(r < 0)
+        r -= ni*(r >= ni)
+        return r.view(np.uint64)
+    return mulmod
+
+def _powmod(a, e, mulmod):
+    """Returns a**e elementwise, by binary exponentiation with mulmod."""
+    result = np.ones_like(a)
+    a = a.copy()
+    e = e.copy()
+    while e.any():
+        odd = (e & 1) != 0
+        result = np.where(odd, mulmod(result, a), result)
+        a = mulmod(a, a)
+        e >>= 1
+    return result
+
+def _miller_rabin_batch(n, bases, make_mulmod):
+    """Returns a mask of the odd n > 2 which are strong probable primes to
+    all the given bases.
+
+    make_mulmod(n) must return a function computing a*b % n elementwise."""
+    # Write n-1 = d*2**s with d odd
+    d = n - 1
+    s = np.zeros(n.shape, dtype=np.int64)
+    even = (d & 1) == 0
+    while even.any():
+        d[even] >>= 1
+        s[even] += 1
+        even = (d & 1) == 0
+
+    passed = np.ones(n.shape, dtype=np.bool_)
+    # Only the numbers which passed all the previous bases are tested again,
+    # which usually leaves just the primes after the first base.
+    idx = np.arange(n.size)
+    for base in bases:
+        m, mm1, si = n[idx], n[idx]-1, s[idx]
+        mulmod = make_mulmod(m)
+        a = np.uint64(base) % m
+        x = _powmod(a, d[idx], mulmod)
+        ok = (a == 0) | (x == 1) | (x == mm1)
+        for r in xrange(1, si.max()):
+            x = mulmod(x, x)
+            ok |= (x == mm1) & (r < si)
+        passed[idx[~ok]] = False
+        idx = idx[ok]
+        if not idx.size:
+            break
+    return passed
+
+def _miller_rabin(n, bases):
+    """Scalar version of _miller_rabin_batch, using Python integers."""
+    d, s = n-1, 0
+    while d % 2 == 0:
+        d //= 2
+        s += 1
+    for a in bases:
+        a %= n
+        if a == 0:
+            continue
+        x = pow(a, d, n)
+        if x == 1 or x == n-1:
+            continue
+        for r in xrange(s-1):
+            x = x*x % n
+            if x == n-1:
+                break
+        else:
+            return False
+    return True
+
+def isprime_batch(n):
+    """Returns a boolean mask telling which entries of the array n are prime.
+
+    n must hold non-negative integers below 2**64 (it is converted to
+    uint64).  Candidates are trial divided by the primes below 256, and the
+    survivors are decided by deterministic Miller-Rabin tests, vectorized
+    over the whole batch."""
+    n = np.asarray(n, dtype=np.uint64)
+    flat = n.ravel()
+    mask = flat >= 2
+    # Trial division by the small primes
+    for p in _SMALL_PRIMES:
+        mask &= (flat % p != 0) | (flat == p)
+    undecided = mask & (flat >= _SMALL_PRIMES[-1]**2)
+
+    # Miller-Rabin, in NumPy for n < _MULMOD_LD_MAX and with Python integers
+    # above that
+    tiers = [(0, 2**32, _MR_BASES_32, _mulmod_32),
+             (2**32, _MULMOD_LD_MAX, _MR_BASES_64, _mulmod_ld)]
+    for lo, hi, bases, make_mulmod in tiers:
+        idx = np.flatnonzero(undecided & (flat >= lo) & (flat < hi))
+        if idx.size:
+            mask[idx] = _miller_rabin_batch(flat[idx], bases, make_mulmod)
+    for i in np.flatnonzero(undecided & (flat >= _MULMOD_LD_MAX)):
+        mask[i] = _miller_rabin(int(flat[i]), _MR_BASES_64)
+    return mask.reshape(n.shape)
+
+def isprime(n):
+    """Returns 1 if n is prime and 0 otherwise."""
+    return int(isprime_batch([n])[0])
+
+#-----------------------------------------------------------------------------
+# Prime sums and counts
+#-----------------------------------------------------------------------------
+
+def sum_primes(n):
+    """Returns the sum of the primes less than n."""
+    return int(sieve(n-1).sum())
+
+def prime_pi(n):
+    """Returns the number of primes less than or equal to n."""
+    return sieve(n).size
+
+def sum_primes_many(ns):
+    """Returns an array with sum_primes(n) for each n in the sequence ns.
+
+    All the queries are answered from a single sieve up to max(ns) and the
+    prefix sums of its primes, instead of one sieve per query.  The sums are
+    int64, so they overflow for n beyond about 2*10**10."""
+    ns = np.asarray(ns, dtype=np.int64)
+    if not ns.size:
+        return np.zeros(ns.shape, dtype=np.int64)
+    primes = sieve(ns.max()-1)
+    prefix = np.concatenate(([0], np.cumsum(primes)))
+    # Number of primes < n for each query
+    return prefix[np.searchsorted(primes, ns)]
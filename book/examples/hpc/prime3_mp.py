@@ -0,0 +1,67 @@
+"""prime3_mp.py: Parallelize the segmented sieve of prime3 using multiprocessing."""
+
+from timeit import default_timer as timer
+from multiprocessing import Pool, cpu_count
+
+import numpy as np
+
+from prime3 import isqrt, base_primes, sieve_range
+from speedup import speedup, parallel_fraction
+
+ncpus = cpu_count()
+
+def split_range(lo, hi, nsegments):
+    """Split [lo, hi) into nsegments disjoint, contiguous (lo, hi) ranges."""
+    edges = np.linspace(lo, hi, nsegments+1).astype(np.int64).tolist()
+    return zip(edges[:-1], edges[1:])
+
+def _sieve_task(args):
+    lo, hi, primes = args
+    return sieve_range(lo, hi, primes)
+
+def parallel_sieve(pool, n, nsegments=None):
+    """Returns a NumPy array with the primes up to n, sieved in parallel.
+
+    [2, n] is split into nsegments disjoint ranges (4 per core by default, to
+    even out the load), each sieved by a worker of pool against the same base
+    primes up to sqrt(n).  pool.map returns the results in order, so they
+    can simply be concatenated."""
+    if nsegments is None:
+        nsegments = 4*ncpus
+    # The base primes are only O(sqrt(n)) in size, so they are computed once
+    # here and shipped along with each segment.
+    primes = base_primes(isqrt(n))
+    tasks = [(lo, hi, primes) for lo, hi in split_range(2, n+1, nsegments)]
+    return np.concatenate(pool.map(_sieve_task, tasks))
+
+if __name__ == '__main__':
+    pool = Pool()
+    n = 2*10**8
+
+    # Serial calculation
+    t1 = timer()
+    serial_primes = sieve_range(2, n+1)
+    t2 = timer()
+    serial_sieve = t2-t1
+    print "Serial sieve time: ", serial_sieve
+
+    # Parallel calculation
+    t1 = timer()
+    parallel_primes = parallel_sieve(pool, n)
+    t2 = timer()
+    parallel_sieve_time = t2-t1
+    print "Parallel sieve time: ", parallel_sieve_time
+
+    assert np.array_equal(serial_primes, parallel_primes), "sieves differ!"
+
+    S = serial_sieve/parallel_sieve_time
+    print "Speedup of the sieve on %i cores: %f" % (ncpus, S)
+
+    # Compare against Amdahl's law: estimate the parallel fraction from the
+    # measured speedup and extrapolate it to larger machines.
+    if ncpus > 1:
+        P = parallel_fraction(S, ncpus)
+        print "Parallel fraction P from Amdahl's law: %f" % P
+        for N in [8, 16, 32, 64]:
+            print "Amdahl speedup on %2i cores: %6.2f (linear: %i)" % \
+                (N, speedup(P, N), N)
@@ -31,6 +31,130 @@ def ensemble_diffs(num, N):
         diffs[i] = center_eigval_diff(mat)
     return diffs
 
+def GOE_stack(num, N, rng=None):
+    """Creates a (num,N,N) stack of elements of the Gaussian Orthogonal
+    Ensemble, using the global numpy.random state or else the RandomState
+    rng.
+
+    The random numbers are drawn in the same order as num calls to GOE(N)
+    would draw them, so both give the same matrices for the same seed."""
+    if rng is None:
+        rng = ra
+    m = rng.standard_normal((num,N,N))
+    # m += m.swapaxes(1,2) would make NumPy copy the whole stack, because the
+    # operands overlap.  Symmetrizing one row at a time only needs a
+    # temporary of num*N elements.
+    for i in xrange(1, N):
+        row = m[:,i,:i] + m[:,:i,i]
+        m[:,i,:i] = row
+        m[:,:i,i] = row
+    m.reshape(num, N*N)[:,::N+1] *= 2
+    return m
+
+# Memory used by each chunk of matrices in ensemble_diffs_batched
+CHUNK_BYTES = 2**26
+
+def ensemble_diffs_batched(num, N, chunk_bytes=CHUNK_BYTES, rng=None):
+    """Return an array of num eigenvalue differences for the NxN GOE
+    ensemble, like ensemble_diffs.
+
+    The matrices are generated and diagonalized as whole stacks, in chunks of
+    at most chunk_bytes.  GOE matrices are symmetric, so the stacked
+    symmetric solver eigvalsh can be used: it is much faster than eigvals,
+    and its eigenvalues are real and already sorted.
+
+    The random numbers come from rng if given (see GOE_stack)."""
+    chunk = max(1, chunk_bytes//(8*N*N))
+    diffs = np.empty(num)
+    for start in xrange(0, num, chunk):
+        stop = min(start+chunk, num)
+        evals = la.eigvalsh(GOE_stack(stop-start, N, rng))
+        diffs[start:stop] = evals[:,N/2] - evals[:,N/2-1]
+    return diffs
+
+# Number of matrices in each independently seeded block of the ensemble in
+# parallel_ensemble_diffs.
+BLOCK_SIZE = 64
+
+def _ensemble_blocks(num, block_size):
+    """Return (block, size) pairs splitting num matrices into blocks."""
+    return [(block, min(block_size, num-start))
+            for block, start in enumerate(xrange(0, num, block_size))]
+
+def block_diffs(args):
+    """Return the eigenvalue differences for one block of the ensemble.
+
+    args is a (seed, block, num, N) tuple: the block's num NxN matrices are
+    drawn from their own random stream, seeded by both seed and block."""
+    seed, block, num, N = args
+    rng = ra.RandomState([seed, block])
+    return ensemble_diffs_batched(num, N, rng=rng)
+
+def parallel_ensemble_diffs(pool, num, N, seed, block_size=BLOCK_SIZE):
+    """Return an array of num eigenvalue differences for the NxN GOE
+    ensemble, computed in parallel.
+
+    pool is anything with an ordered map method, like the pools in pool.py
+    or multiprocessing.Pool (or None, to run serially).  The ensemble is
+    split into blocks of block_size matrices, each with its own random
+    stream derived from (seed, block index).  The split does not depend on
+    the pool, so the result is the same, bit for bit, for any number of
+    workers, and no worker shares or repeats another one's random numbers."""
+    tasks = [(seed, block, size, N)
+             for block, size in _ensemble_blocks(num, block_size)]
+    if not tasks:
+        return np.empty(0)
+    if pool is None:
+        results = map(block_diffs, tasks)
+    else:
+        results = pool.map(block_diffs, tasks)
+    return np.concatenate(results)
+
+# Number of tasks parallel_ensemble_histogram splits the blocks into.  Each
+# task sends back a single histogram, so this bounds the memory used by the
+# results whatever the size of the ensemble.
+HISTOGRAM_TASKS = 64
+
+def block_histogram(args):
+    """Return the SpacingHistogram for a range of blocks of the ensemble.
+
+    args is a (seed, first, last, num, N, edges, block_size) tuple: the
+    blocks first <= block < last of an ensemble of num NxN matrices split
+    into blocks of block_size, each drawn as in block_diffs."""
+    seed, first, last, num, N, edges, block_size = args
+    hist = SpacingHistogram(edges)
+    for block in xrange(first, last):
+        rng = ra.RandomState([seed, block])
+        size = min(block_size, num-block*block_size)
+        hist.add(ensemble_diffs_batched(size, N, rng=rng))
+    return hist
+
+def parallel_ensemble_histogram(pool, num, N, seed, edges=None,
+                                block_size=BLOCK_SIZE,
+                                ntasks=HISTOGRAM_TASKS):
+    """Return a SpacingHistogram of num center eigenvalue differences for the
+    NxN GOE ensemble, computed in parallel.
+
+    Same as parallel_ensemble_diffs, but the blocks are grouped into at most
+    ntasks contiguous ranges, and each worker only sends back the histogram
+    of its range.  Neither the tasks nor the results grow with num, so any
+    num fits in memory.  The blocks see the same matrices as in
+    parallel_ensemble_diffs with the same seed."""
+    if edges is None:
+        edges = spacing_edges(N)
+    nblocks = -(-num//block_size)
+    bounds = [nblocks*i//ntasks for i in xrange(ntasks+1)]
+    tasks = [(seed, first, last, num, N, edges, block_size)
+             for first, last in zip(bounds[:-1], bounds[1:]) if last > first]
+    if pool is None:
+        results = map(block_histogram, tasks)
+    else:
+        results = pool.map(block_histogram, tasks)
+    hist = SpacingHistogram(edges)
+    for block_hist in results:
+        hist.merge(block_hist)
+    return hist
+
 def normalize_diffs(diffs):
     """Normalize an array of eigenvalue diffs."""
     return diffs/diffs.mean()
@@ -50,6 +174,77 @@ def generate_wigner_data():
     s = np.linspace(0.0,4.0,400)
     rhos = wigner_dist(s)
     return s, rhos
+
+def spacing_edges(N, nbins=100, smax=5.0):
+    """Return histogram bin edges for the raw center eigenvalue differences
+    of the NxN GOE, covering normalized spacings from 0 to smax.
+
+    The mean spacing at the center of the spectrum of GOE(N) is close to
+    pi*sqrt(2/N) (from Wigner's semicircle law), so that is used to scale
+    the edges.  The exact normalization is done later, with the measured
+    mean."""
+    return np.linspace(0.0, smax*np.pi*np.sqrt(2.0/N), nbins+1)
+
+class SpacingHistogram(object):
+    """Streaming accumulator for the distribution of eigenvalue spacings.
+
+    Rather than keeping every difference, it keeps a histogram over fixed
+    bin edges plus the count and sum of all the differences.  That is enough
+    to normalize by the global mean at the end, and histograms computed
+    separately (for example by different workers) can be merged."""
+
+    def __init__(self, edges):
+        self.edges = np.asarray(edges, dtype=float)
+        self.counts = np.zeros(len(self.edges)-1, dtype=np.int64)
+        self.count = 0
+        self.total = 0.0
+
+    def add(self, diffs):
+        """Accumulate an array of eigenvalue differences."""
+        diffs = np.asarray(diffs)
+        self.counts += np.histogram(diffs, self.edges)[0]
+        self.count += diffs.size
+        self.total += diffs.sum()
+
+    def merge(self, other):
+        """Accumulate the contents of another SpacingHistogram."""
+        if not np.array_equal(self.edges, other.edges):
+            raise ValueError('histograms must have the same bin edges')
+        self.counts += other.counts
+        self.count += other.count
+        self.total += other.total
+
+    def mean(self):
+        """Return the mean of all the differences accumulated so far."""
+        return self.total/self.count
+
+    def normalized(self):
+        """Return (s, rho(s)) for the distribution of the normalized spacings.
+
+        s are the bin centers, rescaled by the mean difference, and rho is the
+        density in each bin, so they can be compared with wigner_dist(s).
+        Differences beyond the last edge count in the normalization, but not
+        in any bin."""
+        s_edges = self.edges/self.mean()
+        rho = self.counts/(self.count*np.diff(s_edges))
+        return 0.5*(s_edges[1:]+s_edges[:-1]), rho
+
+def ensemble_histogram(num, N, edges=None, chunk_bytes=CHUNK_BYTES, rng=None):
+    """Return a SpacingHistogram of num center eigenvalue differences for the
+    NxN GOE ensemble.
+
+    The matrices are processed in chunks of chunk_bytes as in
+    ensemble_diffs_batched, and each chunk of differences is discarded once
+    added, so memory use does not grow with num.  edges defaults to
+    spacing_edges(N)."""
+    if edges is None:
+        edges = spacing_edges(N)
+    hist = SpacingHistogram(edges)
+    chunk = max(1, chunk_bytes//(8*N*N))
+    for start in xrange(0, num, chunk):
+        hist.add(ensemble_diffs_batched(min(chunk, num-start), N,
+                                        chunk_bytes, rng))
+    return hist
     
 
 # def serialDiffs(num, N):
@@ -1,3 +1,5 @@
+import numpy as np
+
 import pool
 import randmat
 import multiprocessing
@@ -6,3 +8,25 @@ import multiprocessing
 if __name__ == '__main__':
     pp = pool.SimpleThreadPool(2)
     result = pp.map(randmat.eigvals_from_dim, 4*[500])
+    pp.close()
+
+    # With processes, ship the matrices and the eigenvalues through shared
+    # memory instead of pickling them.
+    mats = pool.SharedArray.from_array([randmat.GOE(500) for i in range(4)])
+    evals = pool.SharedArray((4, 500))
+    with pool.SimpleProcessPool(2) as pp:
+        pp.map_array(randmat.sorted_real_eigvals, mats, evals)
+        # Plain arrays work too, at the cost of a copy in and out.
+        plain_evals = pp.map_array(randmat.sorted_real_eigvals, mats.array,
+                                   np.zeros((4, 500)))
+    assert np.array_equal(plain_evals, evals.array), "map_array lost results!"
+    mats.close()
+    evals.close()
+
+    # A reproducible parallel ensemble: the same seed gives the same diffs
+    # whatever the number of workers.
+    serial_diffs = randmat.parallel_ensemble_diffs(None, 1000, 30, seed=0)
+    for nworkers in [2, 4]:
+        with pool.SimpleProcessPool(nworkers) as pp:
+            diffs = randmat.parallel_ensemble_diffs(pp, 1000, 30, seed=0)
+        assert np.array_equal(diffs, serial_diffs), "ensembles differ!"
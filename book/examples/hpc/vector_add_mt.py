@@ -0,0 +1,41 @@
+"""vector_add_mt.py: Run the nogil vector_add kernel on several threads."""
+
+from timeit import default_timer as timer
+from multiprocessing import cpu_count
+
+import numpy as np
+import pyximport
+pyximport.install(setup_args=dict(include_dirs=[np.get_include()]))
+
+from vector_add import vector_add
+import pool
+
+ncpus = cpu_count()
+
+if __name__ == '__main__':
+    n = 10**7
+    a = np.random.rand(n)
+    b = np.random.rand(n)
+    c = np.empty(n)
+
+    # Serial calculation
+    t1 = timer()
+    vector_add(a, b, c)
+    t2 = timer()
+    serial_time = t2-t1
+    print "Serial vector_add time: ", serial_time
+
+    # Parallel calculation: each thread adds its own slice of a and b into
+    # the same slice of c, with the GIL released.
+    c[:] = 0.0
+    with pool.SimpleThreadPool(ncpus) as tp:
+        t1 = timer()
+        tp.map_slices(vector_add, a, b, c)
+        t2 = timer()
+    parallel_time = t2-t1
+    print "Parallel vector_add time: ", parallel_time
+
+    assert np.array_equal(c, a+b), "results differ!"
+
+    print "Speedup of vector_add on %i cores: %f" % \
+        (ncpus, serial_time/parallel_time)
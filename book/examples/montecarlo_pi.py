@@ -9,15 +9,25 @@ A = pi = 4*int_0^1{sqrt(1-x^2)}
 This integral is then done via MonteCarlo integration.
 
 In this example, we do it both in pure Python and then by calling weave.inline
-to speed up the loop.
+to speed up the loop.  Finally, we do it with NumPy, in chunks, until the
+result has a requested accuracy, and generalize that to any integral computed
+in parallel with mc_integrate.  vr_integrate compares several variance
+reduction methods for the same integral.
 """
 
+import collections
+import itertools
 import math
+import multiprocessing
 import random
 
 import numpy as np
 
-from scipy import weave
+# weave is only available in old versions of scipy
+try:
+    from scipy import weave
+except ImportError:
+    weave = None
 
 
 def v1(n = 100000):
@@ -48,16 +58,329 @@ def v2(n = 100000):
     return_val =  4.0*sm/n;"""
     return weave.inline(code,('n'),support_code=support)
 
+
+class RunningStats(object):
+    """Running count, mean and variance of a stream of samples.
+
+    Samples are added an array at a time, and the statistics of two streams
+    can be merged, using the pairwise update formulas of Chan et al.  This
+    avoids both storing the samples and the cancellation problems of
+    accumulating raw sums of squares."""
+
+    def __init__(self):
+        self.n = 0
+        self.mean = 0.0
+        # Sum of squared deviations from the mean
+        self.m2 = 0.0
+
+    def _update(self, n, mean, m2):
+        total = self.n + n
+        delta = mean - self.mean
+        self.mean += delta*n/total
+        self.m2 += m2 + delta**2*self.n*n/total
+        self.n = total
+
+    def add(self, x):
+        """Add an array of samples."""
+        x = np.asarray(x)
+        if x.size:
+            mean = x.mean()
+            self._update(x.size, mean, ((x-mean)**2).sum())
+
+    def merge(self, other):
+        """Add the samples summarized by another RunningStats."""
+        if other.n:
+            self._update(other.n, other.mean, other.m2)
+
+    def variance(self):
+        """Sample variance."""
+        return self.m2/(self.n-1)
+
+    def stderr(self):
+        """Standard error of the mean."""
+        return math.sqrt(self.variance()/self.n)
+
+
+def v3(target_stderr=1e-4, max_samples=10**8, chunk=2**16, seed=None):
+    """Approximate pi via monte carlo integration, to a given accuracy.
+
+    The samples of 4*sqrt(1-x**2) are drawn and evaluated with NumPy, chunk
+    at a time, and only their running mean and variance are kept.  We stop
+    as soon as the standard error of the mean is below target_stderr, or
+    after max_samples samples.
+
+    Returns (pi estimate, standard error, number of samples)."""
+
+    rng = np.random.RandomState(seed)
+    stats = RunningStats()
+    while stats.n < max_samples:
+        x = rng.random_sample(min(chunk, max_samples-stats.n))
+        stats.add(4.0*np.sqrt(1.0-x*x))
+        if stats.n > 1 and stats.stderr() <= target_stderr:
+            break
+    return stats.mean, stats.stderr(), stats.n
+
+
+def quarter_circle(x):
+    """The integrand for pi/4 over [0,1], vectorized."""
+    return np.sqrt(1.0-x*x)
+
+
+def _mc_chunk(args):
+    """Return the RunningStats of volume*f over one chunk of samples.
+
+    The chunk with a given index always gets the same samples, from its own
+    random stream seeded by (seed, index)."""
+    f, lo, hi, seed, index, n = args
+    rng = np.random.RandomState([seed, index])
+    u = rng.random_sample((len(lo), n))
+    x = lo[:,np.newaxis] + (hi-lo)[:,np.newaxis]*u
+    if len(lo) == 1:
+        x = x[0]
+    stats = RunningStats()
+    stats.add(np.prod(hi-lo)*f(x))
+    return stats
+
+
+def _imap_window(pool, func, iterable, window):
+    """Like pool.imap, but only keep window tasks submitted at a time, so
+    that iterable can be endless."""
+    pending = collections.deque()
+    for args in iterable:
+        pending.append(pool.apply_async(func, (args,)))
+        if len(pending) >= window:
+            yield pending.popleft().get()
+    while pending:
+        yield pending.popleft().get()
+
+
+def mc_integrate(f, domain, target_stderr, seed=0, max_samples=10**8,
+                 chunk=2**16, processes=None):
+    """Monte Carlo integration of f over a box, to a given accuracy.
+
+    Inputs:
+      - f: a vectorized function.  For a 1-d domain it gets an array of n
+      points; for a d-dimensional one, a (d,n) array of coordinates.
+
+      - domain: an (a,b) pair for the interval [a,b], or a sequence of such
+      pairs, one per dimension.
+
+      - target_stderr: we stop as soon as the standard error of the result
+      is below this, or after max_samples samples.
+
+    Optional inputs:
+      - seed(0): the random seed.  Chunk i of the samples always comes from
+      its own random stream seeded by (seed, i).
+
+      - chunk(2**16): the number of samples in each chunk.
+
+      - processes(None): the number of worker processes, by default one per
+      core.  With processes=1 everything runs in this process.
+
+    The chunks are evaluated by the workers, which only send back their
+    count, mean and variance (see RunningStats).  These are merged in chunk
+    order, and the stopping rule is checked after each one.  So the result
+    is the same for a given seed whatever the number of processes.  f must
+    be picklable (defined at the top level of a module).
+
+    Output:
+      - (integral estimate, standard error, number of samples)."""
+
+    bounds = np.array(domain, dtype=float).reshape(-1, 2)
+    lo, hi = bounds[:,0], bounds[:,1]
+    nchunks = -(-max_samples//chunk)
+    tasks = ((f, lo, hi, seed, index, min(chunk, max_samples-index*chunk))
+             for index in xrange(nchunks))
+
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+    if processes == 1:
+        pool = None
+        results = itertools.imap(_mc_chunk, tasks)
+    else:
+        pool = multiprocessing.Pool(processes)
+        # Enough chunks in flight to keep every worker busy
+        results = _imap_window(pool, _mc_chunk, tasks, 4*processes)
+
+    stats = RunningStats()
+    try:
+        for chunk_stats in results:
+            stats.merge(chunk_stats)
+            if stats.n > 1 and stats.stderr() <= target_stderr:
+                break
+    finally:
+        if pool is not None:
+            pool.terminate()
+    return stats.mean, stats.stderr(), stats.n
+
+#-----------------------------------------------------------------------------
+# Variance reduction
+#-----------------------------------------------------------------------------
+
+def parabola(x):
+    """Control variate for quarter_circle: strongly correlated with it, and
+    with a known integral over [0,1] of 2/3."""
+    return 1.0-x*x
+
+QUARTER_CIRCLE_CONTROL = (parabola, 2.0/3)
+
+
+def van_der_corput(n, base=2):
+    """Return the first n points of the van der Corput sequence in base.
+
+    This is the 1-d Halton sequence, and for base 2 it is also the first
+    dimension of Sobol's sequence."""
+    i = np.arange(n)
+    x = np.zeros(n)
+    denom = 1.0
+    while i.any():
+        denom *= base
+        x += (i % base)/denom
+        i //= base
+    return x
+
+
+# Each method returns (estimate, standard error, evaluations of f), and
+# raises ValueError if n is too small for it to estimate its error.
+
+def _check_samples(n, minimum, method):
+    if n < minimum:
+        raise ValueError('%s needs n >= %i' % (method, minimum))
+
+
+def _vr_plain(f, n, rng, control):
+    _check_samples(n, 2, 'plain')
+    y = f(rng.random_sample(n))
+    return y.mean(), y.std(ddof=1)/math.sqrt(n), n
+
+
+def _vr_antithetic(f, n, rng, control):
+    # Each sample u is paired with 1-u: for a monotonic f the two errors
+    # partly cancel.
+    _check_samples(n, 4, 'antithetic')
+    m = n//2
+    u = rng.random_sample(m)
+    y = 0.5*(f(u)+f(1.0-u))
+    return y.mean(), y.std(ddof=1)/math.sqrt(m), 2*m
+
+
+def _vr_stratified(f, n, rng, control):
+    # n//2 strata of equal width with two samples each, the minimum needed
+    # to estimate the variance within each stratum.
+    _check_samples(n, 2, 'stratified')
+    m = n//2
+    u = (np.arange(m)[:,np.newaxis] + rng.random_sample((m, 2)))/m
+    y = f(u)
+    return y.mean(), math.sqrt(y.var(axis=1, ddof=1).sum()/2)/m, 2*m
+
+
+def _vr_control(f, n, rng, control):
+    # Subtract beta*(g(x) - E[g]), with the optimal beta estimated from
+    # the same samples.
+    _check_samples(n, 3, 'control')
+    if control is None:
+        raise ValueError('control needs a (g, integral of g) control argument')
+    g, g_mean = control
+    u = rng.random_sample(n)
+    y, c = f(u), g(u)
+    beta = np.cov(y, c)[0,1]/c.var(ddof=1)
+    z = y - beta*(c-g_mean)
+    return z.mean(), z.std(ddof=1)/math.sqrt(n), n
+
+
+def _vr_qmc(f, n, rng, control, replicas=16):
+    # Randomized quasi-Monte Carlo: the same van der Corput points with
+    # independent random shifts (mod 1).  The spread between the replicas
+    # gives the error estimate.
+    _check_samples(n, 2*replicas, 'qmc')
+    m = n//replicas
+    points = van_der_corput(m)
+    shifts = rng.random_sample(replicas)[:,np.newaxis]
+    means = f((points + shifts) % 1.0).mean(axis=1)
+    return means.mean(), means.std(ddof=1)/math.sqrt(replicas), m*replicas
+
+
+VR_METHODS = collections.OrderedDict([
+    ('plain', _vr_plain),
+    ('antithetic', _vr_antithetic),
+    ('stratified', _vr_stratified),
+    ('control', _vr_control),
+    ('qmc', _vr_qmc),
+    ])
+
+
+def vr_integrate(f, n, method='plain', seed=None, control=None):
+    """Monte Carlo integration of f over [0,1] with variance reduction.
+
+    Inputs:
+      - f: a vectorized function.
+
+      - n: the number of evaluations of f to use.  Methods which sample in
+      pairs or replicas round it down to a multiple of their group size, and
+      a ValueError is raised if n is too small for the method.
+
+    Optional inputs:
+      - method('plain'): one of the keys of VR_METHODS: plain uniform
+      sampling, antithetic variates, stratified sampling, a control variate
+      or randomized quasi-Monte Carlo (van der Corput/Halton/Sobol points).
+
+      - seed(None): the random seed.
+
+      - control(None): for the 'control' method, a (g, integral of g over
+      [0,1]) pair, where g is a cheap function correlated with f.  It is
+      required by that method (QUARTER_CIRCLE_CONTROL suits quarter_circle).
+
+    Output:
+      - (integral estimate, standard error, effective variance).  The
+      effective variance is the number of evaluations of f actually made
+      times the squared standard error, the variance per evaluation of f:
+      reaching a standard error e takes about effective_variance/e**2
+      evaluations, so the method with the lowest one is the cheapest.  (For
+      stratified and qmc the error falls faster than 1/sqrt(n), so for them
+      this is only valid near n.)"""
+    rng = np.random.RandomState(seed)
+    estimate, stderr, nevals = VR_METHODS[method](f, n, rng, control)
+    return estimate, stderr, nevals*stderr**2
+
 if __name__ == '__main__':
 
     # Monte Carlo Pi:
     print 'pi is:', math.pi
     print 'pi - python:',v1()
-    print 'pi - weave :',v2()
+    if weave is not None:
+        print 'pi - weave :',v2()
+    print 'pi - numpy :',v3(0, 100000)[0]
 
     from timeit import timeit
     tpy = timeit('v1()','from montecarlo_pi import v1', number=10)/10.0
-    tw = timeit('v2()','from montecarlo_pi import v2', number=10)/10.0
     print 'Python time %.2g s' % tpy
-    print 'Weave time %.2g s' % tw
-    print 'Weave speedup:',tpy/tw
+    if weave is not None:
+        tw = timeit('v2()','from montecarlo_pi import v2', number=10)/10.0
+        print 'Weave time %.2g s' % tw
+        print 'Weave speedup:',tpy/tw
+    # With target_stderr=0 we always draw max_samples samples
+    tnp = timeit('v3(0, 100000)','from montecarlo_pi import v3',
+                 number=10)/10.0
+    print 'NumPy time %.2g s' % tnp
+    print 'NumPy speedup:',tpy/tnp
+
+    # Now ask for an accuracy instead of a number of samples
+    for target in [1e-2, 1e-3, 1e-4]:
+        pi, err, n = v3(target)
+        print 'pi - numpy to %.0e: %.8f +- %.1e (%i samples, error %.1e)' % \
+            (target, pi, err, n, abs(pi-math.pi))
+
+    # The same integral, on all cores
+    area, err, n = mc_integrate(quarter_circle, (0, 1), 2.5e-5)
+    print 'pi - parallel: %.8f +- %.1e (%i samples, error %.1e)' % \
+        (4*area, 4*err, n, abs(4*area-math.pi))
+
+    # Compare the variance reduction methods
+    n = 2**16
+    print 'Variance reduction with %i evaluations:' % n
+    for method in VR_METHODS:
+        area, err, eff_var = vr_integrate(quarter_circle, n, method, seed=0,
+                                          control=QUARTER_CIRCLE_CONTROL)
+        print ('%-10s pi = %.8f +- %.1e, effective variance %.1e, '
+               'evaluations for 1e-6: %.1e' %
+               (method, 4*area, 4*err, 16*eff_var, 16*eff_var/1e-12))
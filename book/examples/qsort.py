@@ -20,6 +20,11 @@ function quicksort(array)
      return concatenate(quicksort(less), pivot, quicksort(greater))
 """
 
+import numpy as np
+
+# Partitions of at most this many elements are left to insertion sort.
+INSERTION_THRESHOLD = 16
+
 def qsort(lst):
     """Return a sorted copy of the input list.
 
@@ -46,6 +51,128 @@ def qsort(lst):
     return qsort(less_than) + [pivot] + qsort(greater_equal)
 
 
+def _insertion_sort(a, lo, hi):
+    "Sort a[lo:hi] in place by insertion."
+    for i in xrange(lo+1, hi):
+        x = a[i]
+        j = i
+        while j > lo and x < a[j-1]:
+            a[j] = a[j-1]
+            j -= 1
+        a[j] = x
+
+
+def _sift_down(a, lo, root, end):
+    "Restore the max-heap a[lo:end] (rooted at lo) below the node root."
+    x = a[lo+root]
+    child = 2*root+1
+    while child < end-lo:
+        if child+1 < end-lo and a[lo+child] < a[lo+child+1]:
+            child += 1
+        if not x < a[lo+child]:
+            break
+        a[lo+root] = a[lo+child]
+        root = child
+        child = 2*root+1
+    a[lo+root] = x
+
+
+def _heapsort(a, lo, hi):
+    "Sort a[lo:hi] in place by heapsort."
+    n = hi-lo
+    for root in xrange(n//2-1, -1, -1):
+        _sift_down(a, lo, root, hi)
+    for end in xrange(hi-1, lo, -1):
+        a[lo], a[end] = a[end], a[lo]
+        _sift_down(a, lo, 0, end)
+
+
+def _partition(a, lo, hi):
+    """Partition a[lo:hi] around the median of its first, middle and last
+    elements.  Returns p, with lo < p < hi, such that every element of
+    a[lo:p] is <= every element of a[p:hi]."""
+    mid = (lo+hi-1)//2
+    # Order the three samples, which also leaves sentinels at both ends
+    if a[mid] < a[lo]:
+        a[lo], a[mid] = a[mid], a[lo]
+    if a[hi-1] < a[mid]:
+        a[mid], a[hi-1] = a[hi-1], a[mid]
+        if a[mid] < a[lo]:
+            a[lo], a[mid] = a[mid], a[lo]
+    pivot = a[mid]
+    # Hoare partition scheme
+    i, j = lo-1, hi
+    while True:
+        i += 1
+        while a[i] < pivot:
+            i += 1
+        j -= 1
+        while pivot < a[j]:
+            j -= 1
+        if i >= j:
+            return j+1
+        a[i], a[j] = a[j], a[i]
+
+
+def _introsort(a, lo, hi, depth):
+    while hi-lo > INSERTION_THRESHOLD:
+        if depth == 0:
+            _heapsort(a, lo, hi)
+            return
+        depth -= 1
+        p = _partition(a, lo, hi)
+        # Recurse into the smaller side and loop on the larger one, so the
+        # stack depth stays O(log n).
+        if p-lo < hi-p:
+            _introsort(a, lo, p, depth)
+            lo = p
+        else:
+            _introsort(a, p, hi, depth)
+            hi = p
+    _insertion_sort(a, lo, hi)
+
+
+def introsort(lst):
+    """Sort the input list in place, and return it.
+
+    This is quicksort with median-of-three pivots, which is O(n log n) on
+    already sorted input, and insertion sort for small partitions.  If the
+    recursion gets deeper than 2*log2(n) levels, the partition is heapsorted
+    instead, so the worst case is O(n log n) too.
+
+    Input:
+
+      lst : a list of elements which can be compared.
+
+    Examples:
+
+    >>> introsort([3,2,5])
+    [2, 3, 5]
+    """
+    _introsort(lst, 0, len(lst), 2*len(lst).bit_length())
+    return lst
+
+
+def fast_sort(lst):
+    """Return a sorted copy of the input list.
+
+    A list of only ints or only floats is sorted by NumPy; any other list is
+    copied and sorted with introsort().
+
+    Examples:
+
+    >>> fast_sort([3,2,5])
+    [2, 3, 5]
+
+    >>> fast_sort(['b','c','a'])
+    ['a', 'b', 'c']
+    """
+    types = set(map(type, lst))
+    if types == set([int]) or types == set([float]):
+        return np.sort(np.array(lst)).tolist()
+    return introsort(list(lst))
+
+
 #-----------------------------------------------------------------------------
 # Tests
 #-----------------------------------------------------------------------------
@@ -66,6 +193,32 @@ def test_random():
     sseq = qsort(rseq)
     nt.assert_equal(tseq,sseq)
 
+def check_introsort(seq):
+    nt.assert_equal(introsort(list(seq)),sorted(seq))
+
+def test_introsort():
+    n = 5000
+    rseq = range(n)
+    random.shuffle(rseq)
+    for seq in [[], [1], range(n), range(n,0,-1), [7]*n, rseq,
+                [random.randint(0,10) for i in range(n)],
+                [random.random() for i in range(n)]]:
+        yield check_introsort, seq
+
+def test_heapsort():
+    seq = [random.random() for i in range(100)]
+    a = list(seq)
+    _introsort(a,0,len(a),0)
+    nt.assert_equal(a,sorted(seq))
+
+def test_fast_sort():
+    seq = [random.randint(-100,100) for i in range(100)]
+    sseq = fast_sort(seq)
+    nt.assert_equal(sseq,sorted(seq))
+    nt.assert_true(all(type(x) is int for x in sseq))
+    mixed = [3, 1.5, 2]
+    nt.assert_equal(fast_sort(mixed),[1.5, 2, 3])
+
 # If called from the command line, run all the tests
 if __name__ == '__main__':
     # This call form is ipython-friendly
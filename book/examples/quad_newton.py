@@ -2,11 +2,15 @@
 """Root finding using SciPy's Newton's method routines.
 """
 
+from bisect import bisect_left
 from math import sin
 
+import numpy as np
 from scipy.integrate import quad
 from scipy.optimize import newton
 
+from trapezoid import sample
+
 # test input function
 def f(t):
     return t*(sin(t))**2
@@ -21,17 +25,179 @@ def gn(t):
     u = 0.25
     return quad(f,0.0,t)[0] - u
 
-# main
-tguess = 10.0
 
-print '"Exact" solution (knowing the analytical form of the integral)'
-t0 = newton(g,tguess,f)
-print "t0, g(t0) =",t0,g(t0)
+class CachedIntegral(object):
+    """The function G(t) = integral of f from a to t, minus u.
+
+    Every value computed is kept as a checkpoint (t_i, F(t_i)), and F(t) is
+    obtained from the nearest checkpoint plus quad() over the short segment
+    between it and t.  The successive iterates of Newton's method get closer
+    together, so each step only integrates over the last step's length
+    instead of from a.
+
+    An instance can be passed directly to newton(), with its derivative()
+    method (which is just f) as fprime:
+
+      G = CachedIntegral(f,0.0,0.25)
+      t = newton(G,10.0,G.derivative)
+
+    The number of evaluations of f used so far is kept in nevals."""
+
+    def __init__(self, f, a=0.0, u=0.0):
+        self.f = f
+        self.u = u
+        self.nevals = 0
+        # Sorted checkpoint abscissas, and the integral from a to each
+        self._t = [a]
+        self._F = [0.0]
+
+    def integral(self, t):
+        "Return the integral of f from a to t."
+        i = bisect_left(self._t, t)
+        if i < len(self._t) and self._t[i] == t:
+            return self._F[i]
+        # Pick the nearest of the two checkpoints around t
+        if i == len(self._t) or (i > 0 and t-self._t[i-1] < self._t[i]-t):
+            i -= 1
+        value, err, info = quad(self.f, self._t[i], t, full_output=1)[:3]
+        self.nevals += info['neval']
+        F = self._F[i] + value
+        j = bisect_left(self._t, t)
+        self._t.insert(j, t)
+        self._F.insert(j, F)
+        return F
+
+    def __call__(self, t):
+        return self.integral(t) - self.u
+
+    def derivative(self, t):
+        "Return f(t), the derivative of the integral."
+        return self.f(t)
+
+
+def _simpson(f, lo, hi, y0, y2, y4):
+    """Simpson's rule on each interval [lo, hi], and on both of its halves.
+
+    y0, y2 and y4 are the values of f at lo, the midpoint and hi; f is only
+    evaluated at the two quarter points, whose values are returned too."""
+    mid = 0.5*(lo+hi)
+    y1, y3 = np.split(sample(f, np.concatenate((0.5*(lo+mid),
+                                                0.5*(mid+hi)))), 2)
+    h = hi-lo
+    coarse = h/6*(y0+4*y2+y4)
+    fine = h/12*(y0+4*y1+2*y2+4*y3+y4)
+    return coarse, fine, y1, y3
+
+
+def cumulative_integral(f, a, b, tol=1e-10, npts=65, max_passes=40):
+    """Tabulate F(t) = integral of f from a to t on an adaptive grid of [a,b].
+
+    The grid starts with npts equally spaced points.  Each interval whose
+    Simpson estimate differs from that of its two halves by more than its
+    share of tol is split in two.  The halves reuse the values of f already
+    computed at their ends and midpoints, so each interval tested only costs
+    two new evaluations, and all the intervals of a pass are evaluated at
+    once (f is called on arrays when it is vectorized).
+
+    Returns the grid t and the array F of the integral at each point."""
+    edges = np.linspace(a, b, npts)
+    lo, hi = edges[:-1], edges[1:]
+    y_edges, y_mid = np.split(sample(f, np.concatenate((edges,
+                                                        0.5*(lo+hi)))),
+                              [npts])
+    y_lo, y_hi = y_edges[:-1], y_edges[1:]
+    done_lo, done_int = [], []
+    for i in xrange(max_passes):
+        coarse, fine, y_q1, y_q3 = _simpson(f, lo, hi, y_lo, y_mid, y_hi)
+        # Richardson-corrected integral of each interval
+        value = fine + (fine-coarse)/15
+        bad = np.abs(fine-coarse) > 15*tol*(hi-lo)/(b-a)
+        if i == max_passes-1:
+            bad[:] = False
+        done_lo.append(lo[~bad])
+        done_int.append(value[~bad])
+        if not bad.any():
+            break
+        mid = 0.5*(lo[bad]+hi[bad])
+        lo, hi = (np.concatenate((lo[bad], mid)),
+                  np.concatenate((mid, hi[bad])))
+        y_lo, y_mid, y_hi = (np.concatenate((y_lo[bad], y_mid[bad])),
+                             np.concatenate((y_q1[bad], y_q3[bad])),
+                             np.concatenate((y_mid[bad], y_hi[bad])))
+    lo = np.concatenate(done_lo)
+    order = np.argsort(lo)
+    t = np.append(lo[order], b)
+    F = np.concatenate(([0.0], np.cumsum(np.concatenate(done_int)[order])))
+    return t, F
+
+
+def solve_integral(f, u, a, b, tol=1e-10, xtol=1e-12, maxiter=10, order=8):
+    """Solve integral(f, a, t) == u for t, for every entry of the array u.
+
+    f must be positive on [a,b].  The cumulative integral is tabulated once
+    with cumulative_integral(), and inverted for all the targets at once by
+    linear interpolation.  The roots are then polished with vectorized
+    Newton steps, in which the integral from the grid point below each root
+    is computed with an order-point Gauss-Legendre rule.  The cost is
+    O(grid + len(u)) evaluations of f, instead of a Newton solve with nested
+    quad() calls per target.
+
+    Returns an array of t, of the same shape as u.  A ValueError is raised if
+    some targets are outside [0, integral(f, a, b)]."""
+    u = np.asarray(u, dtype=float)
+    if not u.size:
+        return np.empty(u.shape)
+    t_grid, F_grid = cumulative_integral(f, a, b, tol)
+    if u.min() < 0 or u.max() > F_grid[-1]:
+        raise ValueError('targets must be between 0 and %g' % F_grid[-1])
+
+    flat = u.ravel()
+    k = np.clip(np.searchsorted(F_grid, flat, 'right')-1, 0, len(t_grid)-2)
+    t0, F0 = t_grid[k], F_grid[k]
+    t = np.interp(flat, F_grid, t_grid)
+
+    nodes, weights = np.polynomial.legendre.leggauss(order)
+    for i in xrange(maxiter):
+        # Integral of f from t0 to t, on all the segments at once
+        half = 0.5*(t-t0)
+        x = (t0+half)[:,np.newaxis] + half[:,np.newaxis]*nodes
+        fx = sample(f, x.ravel()).reshape(x.shape)
+        G = F0 + half*np.dot(fx, weights) - flat
+        ft = sample(f, t)
+        step = np.where(ft > 0, G/np.where(ft > 0, ft, 1), 0)
+        t = np.clip(t-step, t_grid[k], t_grid[k+1])
+        if np.abs(step).max() <= xtol*max(abs(a), abs(b), 1):
+            break
+    return t.reshape(u.shape)
+
+
+if __name__ == '__main__':
+    tguess = 10.0
+
+    print '"Exact" solution (knowing the analytical form of the integral)'
+    t0 = newton(g,tguess,f)
+    print "t0, g(t0) =",t0,g(t0)
+
+    print
+    print "Solution using the numerical integration technique" 
+    t1 = newton(gn,tguess,f)
+    print "t1, g(t1) =",t1,g(t1)
+
+    print
+    print "Solution reusing the integrals of the previous Newton steps"
+    G = CachedIntegral(f,0.0,0.25)
+    t2 = newton(G,tguess,G.derivative)
+    print "t2, g(t2) =",t2,g(t2)
+    print "Evaluations of f:",G.nevals
 
-print
-print "Solution using the numerical integration technique" 
-t1 = newton(gn,tguess,f)
-print "t1, g(t1) =",t1,g(t1)
+    print
+    print "Solving for many targets u at once"
+    u = np.linspace(0.01,10.0,1000)
+    t = solve_integral(f,u,0.0,10.0)
+    print "t for u=0.25:", solve_integral(f,[0.25],0.0,10.0)[0]
+    G = CachedIntegral(f)
+    print "max |G(t)-u| for %d targets:" % len(u), \
+          max(abs(G.integral(ti)-ui) for ti, ui in zip(t,u))
 
-print
-print "To six digits, the answer in this case is t==1.06601."
+    print
+    print "To six digits, the answer in this case is t==1.06601."
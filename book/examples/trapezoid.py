@@ -3,33 +3,206 @@
 
 import numpy as np
 
-def trapz(x, y):
+# Size in bytes of the blocks of rows read at a time by trapz_blocks().
+BLOCK_BYTES = 2**26
+
+def trapz_weights(x):
+    """Return the weights w such that trapz(x,y) == dot(w,y), for a 1-D x.
+
+    w[i] is half the width of the two intervals around x[i]."""
+    dx = np.diff(x)
+    w = np.empty(len(x))
+    w[0] = 0.5*dx[0]
+    w[-1] = 0.5*dx[-1]
+    w[1:-1] = 0.5*(dx[1:]+dx[:-1])
+    return w
+
+
+def trapz(x, y, axis=-1):
     """Simple trapezoid integrator for sequence-based innput.
 
     Inputs:
       - x,y: arrays of the same length (and more than one element).  If the two
     inputs have different lengths, a ValueError exception is raised.
 
+    Optional inputs:
+      - axis(-1): for an N-D y, the axis to integrate along.  Every 1-D slice
+      of y along it is integrated in one vectorized pass.  x is then either
+      1-D, with one point per entry of that axis, and shared by all slices,
+      or it has the same shape as y, with a grid per slice.
+
     Output:
       - The result of applying the trapezoid rule to the input, assuming that
-      y[i] = f(x[i]) for some function f to be integrated.
+      y[i] = f(x[i]) for some function f to be integrated.  For an N-D y, an
+      array with the integrals, of y's shape without axis.
 
     Minimally modified from matplotlib.mlab."""
 
+    x = np.asarray(x)
+    y = np.asarray(y)
+
     # Sanity checks.
-    if len(x) != len(y):
-        raise ValueError('x and y must have the same length')
-    if len(x) < 2:
+    if y.ndim == 0:
+        raise ValueError('y must have at least one dimension')
+    n = y.shape[axis]
+    if x.ndim == 1:
+        if len(x) != n:
+            raise ValueError('x and y must have the same length')
+    elif x.shape != y.shape:
+        raise ValueError('x must be 1-D or have the same shape as y')
+    if n < 2:
         raise ValueError('x and y must have > 1 element')
 
+    if x.ndim == 1:
+        # A shared grid reduces to a dot product with the trapezoid weights,
+        # which are computed once for all the slices.
+        return np.dot(np.moveaxis(y,axis,-1), trapz_weights(x))
+
     # Efficient application of trapezoid rule via numpy
-    return 0.5*((x[1:]-x[:-1])*(y[1:]+y[:-1])).sum()
+    x = np.moveaxis(x,axis,-1)
+    y = np.moveaxis(y,axis,-1)
+    return 0.5*((x[...,1:]-x[...,:-1])*(y[...,1:]+y[...,:-1])).sum(axis=-1)
+
+
+def trapz_blocks(x, y, block_bytes=BLOCK_BYTES, out=None):
+    """Integrate each row of a 2-D array too large for memory.
+
+    Inputs:
+      - x: the grid, either 1-D and shared by all the rows, or of the same
+      shape as y.  A file name is opened as a memory-mapped .npy file.
+
+      - y: a 2-D array, usually memory-mapped, with one curve per row.  A
+      file name is opened as a memory-mapped .npy file.
+
+    Optional inputs:
+      - block_bytes(BLOCK_BYTES): approximate size of the blocks of rows of y
+      read, and integrated with trapz(), at a time.
+
+      - out(None): an array to store the integrals in.
+
+    Output:
+      - An array with the integral of each row of y."""
 
-def trapzf(f,a,b,npts=100):
+    if isinstance(x, basestring):
+        x = np.load(x, mmap_mode='r')
+    if isinstance(y, basestring):
+        y = np.load(y, mmap_mode='r')
+    x = np.asanyarray(x)
+    if y.ndim != 2:
+        raise ValueError('y must be 2-D')
+    nrows = y.shape[0]
+    if out is None:
+        out = np.empty(nrows)
+    row_bytes = y.shape[1]*y.dtype.itemsize
+    if x.ndim != 1:
+        row_bytes += y.shape[1]*x.dtype.itemsize
+    block = max(1, block_bytes//row_bytes)
+    for start in xrange(0, nrows, block):
+        stop = min(start+block, nrows)
+        xblock = x if x.ndim == 1 else x[start:stop]
+        out[start:stop] = trapz(xblock, y[start:stop])
+    return out
+
+class TrapzAccumulator(object):
+    """Trapezoid-rule integral of a stream of samples, fed in chunks.
+
+    Each call to add() takes the next chunk of (x, y) samples.  The last
+    sample of a chunk is kept, so that the interval between it and the first
+    sample of the next chunk is counted too.  Only O(chunk) memory is used,
+    and the result matches trapz() on the concatenated samples.
+
+    Example:
+      acc = TrapzAccumulator()
+      for x, y in chunks:
+          acc.add(x, y)
+      print acc.integral"""
+
+    def __init__(self, cumulative=False):
+        """If cumulative is true, add() returns the running integral at each
+        sample of the chunk instead of the integral so far."""
+        self.cumulative = cumulative
+        self.integral = 0.0
+        self.npts = 0
+        self._last = None
+
+    def add(self, x, y):
+        """Add a chunk of samples, with x increasing from the previous ones.
+
+        Returns the integral from the first sample ever added up to the last
+        one of this chunk, or if cumulative, an array with the integral up to
+        each sample of the chunk."""
+        x = np.asarray(x, dtype=float)
+        y = np.asarray(y, dtype=float)
+        if x.ndim != 1 or x.shape != y.shape:
+            raise ValueError('x and y must be 1-D and have the same length')
+        if not len(x):
+            return np.empty(0) if self.cumulative else self.integral
+
+        start = self.integral
+        if self._last is not None:
+            last_x, last_y = self._last
+            start += 0.5*(x[0]-last_x)*(y[0]+last_y)
+        areas = 0.5*(x[1:]-x[:-1])*(y[1:]+y[:-1])
+        self._last = x[-1], y[-1]
+        self.npts += len(x)
+        if self.cumulative:
+            running = np.empty(len(x))
+            running[0] = start
+            np.cumsum(areas, out=running[1:])
+            running[1:] += start
+            self.integral = running[-1]
+            return running
+        self.integral = start + areas.sum()
+        return self.integral
+
+
+def sample(f,x):
+    """Return the array of values of f at all the points of the array x.
+
+    If f is vectorized (it returns an array of the same shape as x when called
+    with x), it is called only once, on the whole array.  Otherwise, it is
+    called once per point."""
+    try:
+        y = f(x)
+    except Exception:
+        pass
+    else:
+        if isinstance(y,np.ndarray) and y.shape == x.shape:
+            return y
+    return np.array(map(f,x))
+
+
+def trapz_refinements(f,a,b,npts=100):
+    """Generate successively refined trapezoid-rule integrals of f over [a,b].
+
+    The first value uses npts equally spaced points.  Each following one
+    halves the spacing, and reuses the previous value: only f at the new
+    midpoints is evaluated, since
+
+      T(h/2) = T(h)/2 + h/2 * sum(f(midpoints))
+
+    Yields (integral, npts) pairs, where npts is the total number of points,
+    which is also the number of evaluations of f so far."""
+
+    x = np.linspace(a,b,npts)
+    dx = x[1]-x[0]
+    y = sample(f,x)
+    integral = 0.5*dx*(y[1:]+y[:-1]).sum()
+    while True:
+        yield integral, npts
+        midpoints = x[:-1]+0.5*dx
+        integral = 0.5*integral + 0.5*dx*sample(f,midpoints).sum()
+        x = np.linspace(a,b,2*npts-1)
+        npts = 2*npts-1
+        dx *= 0.5
+
+
+def trapzf(f,a,b,npts=100,tol=None,max_npts=2**20+1):
     """Simple trapezoid-based integrator.
 
     Inputs:
-      - f: function to be integrated.
+      - f: function to be integrated.  If it is vectorized (works on arrays),
+      it is called only once on the whole grid; see sample().
 
       - a,b: limits of integration.
 
@@ -37,22 +210,85 @@ def trapzf(f,a,b,npts=100):
       - npts(100): the number of equally spaced points to sample f at, between
       a and b.
 
+      - tol(None): if given, adaptively refine the grid, by halving the
+      spacing, until two successive estimates differ by less than tol.  Each
+      refinement only evaluates f at the new midpoints; see
+      trapz_refinements().
+
+      - max_npts(2**20+1): in adaptive mode, the maximum number of points to
+      refine to.  If tol has not been reached by then, the last estimate is
+      returned.
+
     Output:
       - The value of the trapezoid-rule approximation to the integral."""
 
+    if tol is None:
+        # Generate an equally spaced grid to sample the function.
+        x = np.linspace(a,b,npts)
 
-    # Generate an equally spaced grid to sample the function.
-    x = np.linspace(a,b,npts)
+        # For an equispaced grid, the x spacing can just be read off from the
+        # first two points and factored out of the summation.
+        dx = x[1]-x[0]
 
-    # For an equispaced grid, the x spacing can just be read off from the first
-    # two points and factored out of the summation.
-    dx = x[1]-x[0]
+        # Sample the input function at all values of x
+        y = sample(f,x)
+
+        # Compute the trapezoid rule sum for the final result
+        return 0.5*dx*(y[1:]+y[:-1]).sum()
+
+    previous = None
+    for integral, n in trapz_refinements(f,a,b,npts):
+        if previous is not None and abs(integral-previous) < tol:
+            break
+        if 2*n-1 > max_npts:
+            break
+        previous = integral
+    return integral
+
+
+def romberg(f,a,b,tol=1e-10,npts=2,max_levels=20):
+    """Romberg integration of f over [a,b].
+
+    The trapezoid-rule integrals of trapz_refinements() T_0, T_1, ... (with
+    spacings h, h/2, ...) have errors which are a series in even powers of h.
+    Richardson extrapolation eliminates these one power at a time:
+
+      R[k][0] = T_k
+      R[k][j] = R[k][j-1] + (R[k][j-1]-R[k-1][j-1])/(4**j-1)
+
+    and R[k][k] converges much faster than T_k for smooth f.
+
+    Inputs:
+      - f: function to be integrated, vectorized or not (see sample()).
+
+      - a,b: limits of integration.
+
+    Optional inputs:
+      - tol(1e-10): stop when two successive diagonal entries R[k][k] differ
+      by less than tol.  At least three levels are always computed, so that a
+      coarse grid which happens to fit f exactly doesn't stop the iteration.
 
-    # Sample the input function at all values of x
-    y = np.array(map(f,x))
+      - npts(2): the number of points of the coarsest grid.
 
-    # Compute the trapezoid rule sum for the final result
-    return 0.5*dx*(y[1:]+y[:-1]).sum()
+      - max_levels(20): the maximum number of refinements.
+
+    Output:
+      - (integral, error, nevals): the estimate, an estimate of its error
+      (the difference between the last two diagonal entries), and the number
+      of evaluations of f."""
+
+    row = []
+    error = np.inf
+    for k, (integral, nevals) in enumerate(trapz_refinements(f,a,b,npts)):
+        new_row = [integral]
+        for j in range(k):
+            new_row.append(new_row[j] + (new_row[j]-row[j])/(4.0**(j+1)-1))
+        if k > 0:
+            error = abs(new_row[k]-row[k-1])
+        row = new_row
+        if (k >= 2 and error < tol) or k >= max_levels:
+            break
+    return row[-1], error, nevals
 
 
 #-----------------------------------------------------------------------------
@@ -79,6 +315,98 @@ def test_square2():
     "Another test integrating the square() function."
     nptest.assert_almost_equal(trapzf(square,0,3,350),9.0,4)
 
+def test_vectorized():
+    "Test that a vectorized function is called only once."
+    calls = []
+    def f(x):
+        calls.append(x)
+        return x**2
+    nptest.assert_almost_equal(trapzf(f,0,1),1./3,4)
+    nt.assert_equal(len(calls),1)
+
+def test_scalar_only():
+    "Test a function that only works on scalars."
+    import math
+    nptest.assert_almost_equal(trapzf(math.exp,0,1),math.e-1,4)
+
+def test_adaptive():
+    "Test adaptive integration to a tolerance."
+    nptest.assert_almost_equal(trapzf(np.sin,0,np.pi,tol=1e-9),2.0,8)
+
+def test_refinements():
+    "Test that refinements reuse the previous samples."
+    points = []
+    def f(x):
+        points.extend(np.atleast_1d(x))
+        return x**2
+    refinements = trapz_refinements(f,0,1,5)
+    for i in range(4):
+        integral, npts = refinements.next()
+    nt.assert_equal(npts,33)
+    nt.assert_equal(len(points),33)
+    nptest.assert_almost_equal(integral,trapzf(square,0,1,33),12)
+
+def test_trapz_axis():
+    "Test batched integration along an axis with a shared grid."
+    x = np.linspace(0,1,50)
+    y = np.array([x, x**2, x**3]).T
+    nptest.assert_almost_equal(trapz(x,y,axis=0),
+                               [trapz(x,y[:,i]) for i in range(3)],14)
+
+def test_trapz_rows():
+    "Test batched integration with a different grid for each row."
+    x = np.array([np.linspace(0,1,40), np.linspace(0,2,40)])
+    y = x**2
+    nptest.assert_almost_equal(trapz(x,y),[1./3,8./3],3)
+    nt.assert_raises(ValueError,trapz,x[:,:10],y)
+
+def test_trapz_blocks():
+    "Test out-of-core integration of a memory-mapped array."
+    import os, tempfile
+    x = np.linspace(0,1,30)
+    y = np.outer(np.arange(1000),x)
+    fd, name = tempfile.mkstemp(suffix='.npy')
+    os.close(fd)
+    try:
+        np.save(name,y)
+        result = trapz_blocks(x,name,block_bytes=8*30*64)
+    finally:
+        os.remove(name)
+    nptest.assert_almost_equal(result,0.5*np.arange(1000),12)
+
+def test_accumulator():
+    "Test streaming integration against trapz() on the whole data."
+    x = np.sort(np.random.uniform(0,5,1000))
+    y = np.sin(x)
+    acc = TrapzAccumulator()
+    for i in range(0,1000,77):
+        acc.add(x[i:i+77],y[i:i+77])
+    nt.assert_equal(acc.npts,1000)
+    nptest.assert_almost_equal(acc.integral,trapz(x,y),12)
+
+def test_accumulator_cumulative():
+    "Test the running integral emitted for each chunk."
+    x = np.linspace(0,1,101)
+    y = x**2
+    acc = TrapzAccumulator(cumulative=True)
+    running = np.concatenate([acc.add(x[i:i+10],y[i:i+10])
+                              for i in range(0,101,10)])
+    nptest.assert_almost_equal(running[-1],trapz(x,y),12)
+    nptest.assert_almost_equal(running[50],trapz(x[:51],y[:51]),12)
+    nt.assert_equal(running[0],0.0)
+
+def test_romberg():
+    "Test Romberg integration to high accuracy with few evaluations."
+    integral, error, nevals = romberg(np.exp,0,1,tol=1e-12)
+    nptest.assert_almost_equal(integral,np.e-1,12)
+    nt.assert_true(error < 1e-12)
+    nt.assert_true(nevals <= 65)
+
+def test_romberg_polynomial():
+    "Test that Romberg integration is exact for low-degree polynomials."
+    integral, error, nevals = romberg(lambda x: x**3-2*x,0,2)
+    nptest.assert_almost_equal(integral,0.0,14)
+
 
 # If called from the command line, run all the tests
 if __name__ == '__main__':